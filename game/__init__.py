@@ -1,5 +1,5 @@
 from .ball import Ball
 from .match import Match, MatchStats
-from .player import Player
+from .player import Player, PlayerBatch
 from .team import Team
 from .referee import Referee
@@ -0,0 +1,30 @@
+import math
+import numpy as np
+from numba import njit
+
+
+@njit("f4[::1](f4[:, ::1], f4[::1])", fastmath=True, cache=True)
+def center_distances(centers: np.ndarray, ball: np.ndarray) -> np.ndarray:
+    """
+    Returns the distance between every player center and the ball
+
+    Parameters
+    ----------
+    centers : np.ndarray
+        Player centers, float32 array of shape (N, 2)
+    ball : np.ndarray
+        Ball center, float32 array of shape (2,)
+
+    Returns
+    -------
+    np.ndarray
+        Distances, float32 array of shape (N,)
+    """
+    n = centers.shape[0]
+    d = np.empty(n, np.float32)
+    for i in range(n):
+        dx = centers[i, 0] - ball[0]
+        dy = centers[i, 1] - ball[1]
+        d[i] = math.sqrt(dx * dx + dy * dy)
+    return d
+
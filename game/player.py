@@ -1,15 +1,118 @@
+from dataclasses import dataclass
+from math import hypot
 from typing import List
 import numpy as np
-import PIL
 from norfair import Detection
 from game.ball import Ball
 from game.team import Team
 from annotations.draw import draw_detection_mask, draw_pointer
-import supervision as sv
+
+
+def _as_mask(mask) -> np.ndarray:
+    """Boolean numpy copy of a segmentation mask, which may be a torch tensor"""
+    if hasattr(mask, "cpu"):
+        mask = mask.cpu().numpy()
+    return np.asarray(mask, dtype=bool)
+
+
+def _attach_team(detection: Detection, team_by_name: dict) -> Detection:
+    """Store the Team matching the detection classification in detection.data"""
+    if "classification" in detection.data:
+        detection.data["team"] = team_by_name.get(detection.data["classification"])
+    return detection
+
+
+@dataclass
+class PlayerBatch:
+    """
+    Structure-of-arrays layout of every player in a frame
+
+    Players built by Player.from_detections are views into one batch, so the
+    per-frame distance kernels can consume the arrays without copying.
+
+    Attributes
+    ----------
+    feet : np.ndarray
+        Left and right foot of each player, float32 array of shape (N, 2, 2)
+    center : np.ndarray
+        Center of each player, float32 array of shape (N, 2)
+    """
+
+    feet: np.ndarray
+    center: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.center)
+
+    @staticmethod
+    def from_detections(detections: List[Detection]) -> "PlayerBatch":
+        """
+        Pack the points of a list of detections into a PlayerBatch
+
+        Parameters
+        ----------
+        detections : List[Detection]
+            List of player detections
+
+        Returns
+        -------
+        PlayerBatch
+            Batch with one row per detection
+        """
+        if detections:
+            points = np.stack([np.asarray(d.points, dtype=np.float32) for d in detections])
+        else:
+            points = np.empty((0, 2, 2), dtype=np.float32)
+
+        feet = np.empty_like(points)
+        feet[:, 0, 0] = points[:, 0, 0]
+        feet[:, 0, 1] = points[:, 1, 1]
+        feet[:, 1] = points[:, 1]
+        center = (points[:, 0] + points[:, 1]) * np.float32(0.5)
+
+        return PlayerBatch(feet=feet, center=center)
+
+    @staticmethod
+    def from_players(players: List["Player"]) -> "PlayerBatch":
+        """
+        Return the batch backing a list of players
+
+        The shared batch is returned as is when the players are exactly its rows,
+        otherwise the rows of the players are gathered into a new batch.
+
+        Parameters
+        ----------
+        players : List[Player]
+            List of Player objects
+
+        Returns
+        -------
+        PlayerBatch
+            Batch with one row per player
+        """
+        batch = players[0].batch if players else None
+        if (
+            batch is not None
+            and len(batch) == len(players)
+            and all(p.batch is batch and p.index == i for i, p in enumerate(players))
+        ):
+            return batch
+
+        # players without a detection get an unreachable position
+        feet = np.full((len(players), 2, 2), np.inf, dtype=np.float32)
+        center = np.full((len(players), 2), np.inf, dtype=np.float32)
+
+        for i, player in enumerate(players):
+            if player.batch is None:
+                continue
+            feet[i] = player.batch.feet[player.index]
+            center[i] = player.batch.center[player.index]
+
+        return PlayerBatch(feet=feet, center=center)
 
 
 class Player:
-    def __init__(self, detection: Detection):
+    def __init__(self, detection: Detection, batch: PlayerBatch = None, index: int = 0):
         """
 
         Initialize Player
@@ -18,6 +121,10 @@ class Player:
         ----------
         detection : Detection
             Detection containing the player
+        batch : PlayerBatch, optional
+            Frame batch holding this player points, built from detection if None
+        index : int, optional
+            Row of this player in batch, by default 0
         """
         self.txy = None # transformed xy
         self.be_xy = None # birds eye view xy
@@ -25,21 +132,63 @@ class Player:
         self.in_possession = False
         self.team = None
 
+        # detection points don't change within a frame, so unpack them once
+        self._p = None
+        self._abs_cache = False
+        self.batch = None
+        self.index = index
+        self._id = detection.data.get("id") if detection else None
+
         if detection:
             if "team" in detection.data:
                 self.team = detection.data["team"]
 
+        if self.team is not None:
+            self._color = self.team.color
+        else:
+            self._color = detection.data.get("color") if detection else None
+
+        if detection:
+            self._p = detection.points
+            self._x1, self._y1 = self._p[0]
+            self._x2, self._y2 = self._p[1]
+            self._cx = (self._x1 + self._x2) * 0.5
+            self._cy = (self._y1 + self._y2) * 0.5
+            self._xy = np.array([(self._x1 + self._x2) * 0.5, min(self._y1, self._y2)])
+
+            if batch is None:
+                batch = PlayerBatch.from_detections([detection])
+                self.index = 0
+            self.batch = batch
+            self._center = batch.center[self.index]
+            self._feet = batch.feet[self.index]
+            self._left_foot = self._feet[0]
+            self._right_foot = self._feet[1]
+
+    def _cache_abs(self):
+        """
+        Unpack the absolute points on first access
+        """
+        points = self.detection.absolute_points
+        (x1, y1), (x2, y2) = points
+        self._x1_abs, self._x2_abs, self._y2_abs = x1, x2, y2
+        self._cx_abs = (x1 + x2) * 0.5
+        self._cy_abs = (y1 + y2) * 0.5
+        self._left_foot_abs = self.get_left_foot(points)
+        self._right_foot_abs = self.get_right_foot(points)
+        self._center_abs = self.get_center(points)
+        self._abs_cache = True
+
     def get_left_foot(self, points: np.array):
         x1, y1 = points[0]
         x2, y2 = points[1]
 
-        return [x1, y2]
+        return np.array([x1, y2])
 
     def get_right_foot(self, points: np.array):
-        return points[1]
+        return np.asarray(points[1])
 
     def get_center(self, points: np.array):
-        points = self.detection.points
         x1, y1 = points[0]
         x2, y2 = points[1]
         center_x = (x1 + x2) / 2
@@ -48,61 +197,45 @@ class Player:
         return center
 
     def get_xy(self):
-        points = self.detection.points
-        x1, y1 = points[0]
-        x2, y2 = points[1]
-        x = (x1 + x2) / 2
-        y = min(y1, y2)
-        xy = np.array([x, y])
-        return xy
+        return self._xy
 
     @property
     def xy(self):
-        return self.get_xy()
+        return self._xy
 
     @property
     def left_foot(self):
-        points = self.detection.points
-        left_foot = self.get_left_foot(points)
-
-        return left_foot
+        return self._left_foot
 
     @property
     def right_foot(self):
-        points = self.detection.points
-        right_foot = self.get_right_foot(points)
-
-        return right_foot
+        return self._right_foot
 
     @property
     def center(self):
-        points = self.detection.points
-        center = self.get_center(points)
-        return center
+        return self._center
 
     @property
     def left_foot_abs(self):
-        points = self.detection.absolute_points
-        left_foot_abs = self.get_left_foot(points)
-
-        return left_foot_abs
+        if not self._abs_cache:
+            self._cache_abs()
+        return self._left_foot_abs
 
     @property
     def right_foot_abs(self):
-        points = self.detection.absolute_points
-        right_foot_abs = self.get_right_foot(points)
-
-        return right_foot_abs
+        if not self._abs_cache:
+            self._cache_abs()
+        return self._right_foot_abs
 
     @property
     def center_abs(self):
-        points = self.detection.absolute_points
-        center_abs = self.get_center(points)
-        return center_abs
+        if not self._abs_cache:
+            self._cache_abs()
+        return self._center_abs
 
     @property
     def feet(self) -> np.ndarray:
-        return np.array([self.left_foot, self.right_foot])
+        return self._feet
 
     def distance_to_ball(self, ball: Ball) -> float:
         """
@@ -119,10 +252,11 @@ class Player:
             Distance between the player closest foot and the ball
         """
 
-        if self.detection is None or ball.center is None:
+        ball_center = ball.center
+        if self.detection is None or ball_center is None:
             return None
 
-        center_distance = np.linalg.norm(ball.center - self.center)
+        center_distance = hypot(ball_center[0] - self._cx, ball_center[1] - self._cy)
 
         return center_distance
 
@@ -146,12 +280,14 @@ class Player:
 
         if ball.center is None:
             if ball.last_detection is not None and ball.last_detection.center is not None:
-                center_distance = np.linalg.norm(ball.last_detection.center - self.center)
+                ball_center = ball.last_detection.center
+                center_distance = hypot(ball_center[0] - self._cx, ball_center[1] - self._cy)
                 return center_distance
             else:
                 return None
 
-        center_distance = np.linalg.norm(ball.detection.center - self.center)
+        ball_center = ball.detection.center
+        center_distance = hypot(ball_center[0] - self._cx, ball_center[1] - self._cy)
         return center_distance
 
     def closest_foot_to_ball(self, ball: Ball) -> np.ndarray:
@@ -170,16 +306,16 @@ class Player:
             Closest foot to the ball (x, y)
         """
 
-        if self.detection is None or ball.center is None:
+        ball_center = ball.center
+        if self.detection is None or ball_center is None:
             return None
 
-        left_foot_distance = np.linalg.norm(ball.center - self.left_foot)
-        right_foot_distance = np.linalg.norm(ball.center - self.right_foot)
-
-        if left_foot_distance < right_foot_distance:
-            return self.left_foot
+        # comparing squared distances picks the same foot without the sqrt
+        bx, by = ball_center
+        lx, ly = bx - self._x1, by - self._y2
+        rx, ry = bx - self._x2, by - self._y2
 
-        return self.right_foot
+        return self._left_foot if lx * lx + ly * ly < rx * rx + ry * ry else self._right_foot
 
     def closest_center_to_ball_abs(self, ball: Ball) -> np.ndarray:
         """
@@ -197,12 +333,20 @@ class Player:
             Closest foot to the ball (x, y)
         """
 
-        if self.detection is None or ball.center_abs is None:
+        ball_center_abs = ball.center_abs
+        if self.detection is None or ball_center_abs is None:
             return None
 
-        center_distance = np.linalg.norm(ball.center_abs - self.center_abs)
+        if not self._abs_cache:
+            self._cache_abs()
+        center_distance = hypot(
+            ball_center_abs[0] - self._cx_abs, ball_center_abs[1] - self._cy_abs
+        )
+        # same as distance_to_ball, inlined on the cached center scalars
+        ball_center = ball.center
+        relative_distance = hypot(ball_center[0] - self._cx, ball_center[1] - self._cy)
 
-        return self.center if center_distance <= self.distance_to_ball(ball) else None
+        return self._center if center_distance <= relative_distance else None
 
     def closest_foot_to_ball_abs(self, ball: Ball) -> np.ndarray:
         """
@@ -220,26 +364,27 @@ class Player:
             Closest foot to the ball (x, y)
         """
 
-        if self.detection is None or ball.center_abs is None:
+        ball_center_abs = ball.center_abs
+        if self.detection is None or ball_center_abs is None:
             return None
 
-        left_foot_distance = np.linalg.norm(ball.center_abs - self.left_foot_abs)
-        right_foot_distance = np.linalg.norm(ball.center_abs - self.right_foot_abs)
-
-        if left_foot_distance < right_foot_distance:
-            return self.left_foot_abs
+        if not self._abs_cache:
+            self._cache_abs()
+        bx, by = ball_center_abs
+        lx, ly = bx - self._x1_abs, by - self._y2_abs
+        rx, ry = bx - self._x2_abs, by - self._y2_abs
 
-        return self.right_foot_abs
+        return self._left_foot_abs if lx * lx + ly * ly < rx * rx + ry * ry else self._right_foot_abs
 
     def draw(
-        self, frame: PIL.Image.Image, confidence: bool = False, id: bool = False, txy: bool = False
-    ) -> PIL.Image.Image:
+        self, frame: np.ndarray, confidence: bool = False, id: bool = False, txy: bool = False
+    ) -> np.ndarray:
         """
         Draw the player on the frame
 
         Parameters
         ----------
-        frame : PIL.Image.Image
+        frame : np.ndarray
             Frame to draw on
         confidence : bool, optional
             Whether to draw confidence text in bounding box, by default False
@@ -248,26 +393,10 @@ class Player:
 
         Returns
         -------
-        PIL.Image.Image
+        np.ndarray
             Frame with player drawn
         """
-        if self.detection is None:
-            return frame
-
-        if self.team is not None:
-            self.detection.data["color"] = self.team.color
-            # print('i')
-            # print(self.detection.data)
-        mask_annotator = sv.MaskAnnotator(color=self.detection.data["color"], opacity=0.5)
-        sv_detections=sv.Detections(xyxy=self.detection.points,
-                                    mask=self.detection.data["mask"],
-                                    tracker_id=self.detection.data["txy"],)
-        annotated_frame = mask_annotator.annotate(
-            scene=frame,
-            detections=sv_detections,
-        )
-
-        return annotated_frame
+        return Player.draw_players([self], frame, confidence=confidence, id=id, txy=txy)
 
     def draw_pointer(self, frame: np.ndarray) -> np.ndarray:
         """
@@ -286,24 +415,26 @@ class Player:
         if self.detection is None:
             return frame
 
-        color = None
-
-        if self.team:
-            color = self.team.color
-
-        return draw_pointer(detection=self.detection, img=frame, color=color)
+        return draw_pointer(detection=self.detection, img=frame, color=self._color)
 
     def __str__(self):
         return f"Player: {self.feet}, team: {self.team}"
 
     def __eq__(self, other: "Player") -> bool:
-        if isinstance(self, Player) == False or isinstance(other, Player) == False:
+        if type(other) is not Player:
             return False
 
-        self_id = self.detection.data["id"]
-        other_id = other.detection.data["id"]
+        # untracked players are only equal to themselves
+        if self._id is None:
+            return self is other
+
+        return self._id == other._id
 
-        return self_id == other_id
+    def __hash__(self) -> int:
+        if self._id is None:
+            return object.__hash__(self)
+
+        return hash(self._id)
 
     @staticmethod
     def have_same_id(player1: "Player", player2: "Player") -> bool:
@@ -322,20 +453,21 @@ class Player:
         bool
             True if they have the same id
         """
-        if not player1 or not player2:
-            return False
-        if "id" not in player1.detection.data or "id" not in player2.detection.data:
-            return False
-        return player1 == player2
+        return (
+            player1 is not None
+            and player2 is not None
+            and player1._id is not None
+            and player1._id == player2._id
+        )
 
     @staticmethod
     def draw_players(
         players: List["Player"],
-        frame: PIL.Image.Image,
+        frame: np.ndarray,
         confidence: bool = False,
         id: bool = False,
         txy: bool = True,
-    ) -> PIL.Image.Image:
+    ) -> np.ndarray:
         """
         Draw all players on the frame
 
@@ -343,7 +475,7 @@ class Player:
         ----------
         players : List[Player]
             List of Player objects
-        frame : PIL.Image.Image
+        frame : np.ndarray
             Frame to draw on
         confidence : bool, optional
             Whether to draw confidence text in bounding box, by default False
@@ -352,12 +484,29 @@ class Player:
 
         Returns
         -------
-        PIL.Image.Image
-            Frame with players drawn
+        np.ndarray
+            Frame with players drawn, the masks are blended in place
         """
-        if players:
-            for player in players:
-                frame = player.draw(frame, confidence=confidence, id=id, txy=txy)
+        players = [player for player in players if player.detection is not None]
+        if not players:
+            return frame
+
+        height, width = frame.shape[:2]
+        # largest box first so smaller players end up on top, like supervision
+        players = sorted(
+            players,
+            key=lambda player: (player._x2 - player._x1) * (player._y2 - player._y1),
+            reverse=True,
+        )
+        for player in players:
+            (x1, y1), (x2, y2) = np.clip(
+                np.rint(player.detection.points), 0, (width, height)
+            ).astype(int)
+            # only the box of the player is read from the mask and blended
+            mask = _as_mask(player.detection.data["mask"][y1:y2, x1:x2])
+            region = frame[y1:y2, x1:x2]
+            color = np.array(player._color or (0, 0, 0), dtype=np.float32)
+            region[mask] = (0.5 * color + 0.5 * region[mask]).astype(np.uint8)
 
         return frame
 
@@ -383,21 +532,21 @@ class Player:
         List[Player]
             List of Player objects
         """
-        players = []
-
+        team_by_name = Team.by_name(teams)
+        detections = [
+            _attach_team(detection, team_by_name)
+            for detection in detections
+            if detection is not None
+        ]
+        # float32 contiguous points all the way down, no hidden upcasts in later math
         for detection in detections:
-            if detection is None:
-                continue
-
-            if "classification" in detection.data:
-                team_name = detection.data["classification"]
-                # print(team_name)
-                team = Team.from_name(teams=teams, name=team_name)
-                detection.data["team"] = team
-                # print(detection.data)
-
-            player = Player(detection=detection)
-
-            players.append(player)
-
-        return players
+            detection.points = np.ascontiguousarray(detection.points, dtype=np.float32)
+            detection.absolute_points = np.ascontiguousarray(
+                detection.absolute_points, dtype=np.float32
+            )
+        batch = PlayerBatch.from_detections(detections)
+
+        return [
+            Player(detection=detection, batch=batch, index=i)
+            for i, detection in enumerate(detections)
+        ]
@@ -1,5 +1,7 @@
 from typing import List
-from game.player import Player
+import numpy as np
+from game._kernels import center_distances
+from game.player import Player, PlayerBatch
 from game.ball import Ball
 from game.team import Team
 
@@ -29,9 +31,12 @@ class Possession:
         self.ball = ball
 
         # Closest player and player in possession calculations
-        closest_player = min(players, key=lambda player: player.distance_to_ball(ball))
+        batch = PlayerBatch.from_players(players)
+        distances = center_distances(batch.center, np.asarray(ball.center, dtype=np.float32))
+        closest = int(np.argmin(distances))
+        self.closest_player = players[closest]
         # Check if the ball is within a certain distance threshold
-        ball_distance = closest_player.distance_to_ball(ball)
+        ball_distance = distances[closest]
         if ball_distance >= self.ball_distance_threshold:
                 self.closest_player = None
                 return # Maybe remove this heuristic?
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, List
 
 
 class Team:
@@ -73,6 +73,23 @@ class Team:
             if team.name == name:
                 return team
 
+    @staticmethod
+    def by_name(teams: List["Team"]) -> Dict[str, "Team"]:
+        """
+        Return a name to team mapping, for repeated lookups in place of from_name
+
+        Parameters
+        ----------
+        teams : List[Team]
+            List of Team objects
+
+        Returns
+        -------
+        Dict[str, Team]
+            Team objects by name
+        """
+        return {team.name: team for team in teams}
+
     def get_percentage_possession(self, duration: int) -> float:
         """
         Return team possession in percentage
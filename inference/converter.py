@@ -145,3 +145,49 @@ class Converter:
             detections.append(detection)
 
         return detections
+
+    @staticmethod
+    def TrackedObjects_to_Predicted_Detections(
+        tracked_objects: List[norfair.tracker.TrackedObject],
+    ) -> List[norfair.Detection]:
+        """
+        Converts a list of norfair.tracker.TrackedObject to a list of norfair.Detection
+        placed at the tracker estimate instead of the last detection.
+
+        Used on frames where the detector was skipped, the data of the last
+        detection (classification, mask, ...) is carried over. The mask is not
+        moved with the estimate, so it lags behind the box until the next
+        detected frame.
+
+        Parameters
+        ----------
+        tracked_objects : List[norfair.tracker.TrackedObject]
+            List of norfair.tracker.TrackedObject
+
+        Returns
+        -------
+        List[norfair.Detection]
+            List of norfair.Detection
+        """
+
+        live_objects = [
+            entity for entity in tracked_objects if entity.live_points.any()
+        ]
+
+        detections = []
+
+        for tracked_object in live_objects:
+            last_detection = tracked_object.last_detection
+            data = dict(last_detection.data)
+            data["id"] = int(tracked_object.id)
+            detection = norfair.Detection(
+                points=tracked_object.estimate,
+                data=data,
+                label=last_detection.label,
+            )
+            if tracked_object.abs_to_rel is not None:
+                # estimate is relative to the frame, keep absolute_points absolute
+                detection.absolute_points = tracked_object.get_estimate(absolute=True)
+            detections.append(detection)
+
+        return detections
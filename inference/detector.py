@@ -84,6 +84,53 @@ class BaseDetection:
 
         return mask
 
+    @staticmethod
+    def generate_predictions_mask_fast(
+        boxes_xyxy: np.ndarray,
+        shape: tuple,
+        margin: int = 0,
+        dtype: np.dtype = np.uint8,
+        out: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Generates a mask of the predictions bounding boxes directly from their coordinates
+
+        Parameters
+        ----------
+        boxes_xyxy : np.ndarray
+            Bounding boxes (xmin, ymin, xmax, ymax), array of shape (N, 4)
+        shape : tuple
+            Shape of the image where the predictions were made
+        margin : int, optional
+            Margin to add to the bounding box, by default 0
+        dtype : np.dtype, optional
+            Mask dtype, by default np.uint8
+        out : np.ndarray, optional
+            Preallocated mask of shape shape[:2] to write to, by default a new one is allocated
+
+        Returns
+        -------
+        np.ndarray
+            Mask of the predictions bounding boxes
+        """
+        height, width = shape[:2]
+        if out is None:
+            mask = np.ones((height, width), dtype=dtype)
+        else:
+            mask = out
+            mask.fill(1)
+
+        boxes = np.rint(np.asarray(boxes_xyxy, dtype=np.float64).reshape(-1, 4)).astype(np.intp)
+        boxes[:, :2] -= margin
+        boxes[:, 2:] += margin
+        np.clip(boxes[:, 0::2], 0, width, out=boxes[:, 0::2])
+        np.clip(boxes[:, 1::2], 0, height, out=boxes[:, 1::2])
+
+        for xmin, ymin, xmax, ymax in boxes:
+            mask[ymin:ymax, xmin:xmax] = 0
+
+        return mask
+
 
 class SahiBallDetection(BaseDetection):
     MODEL_PATH = 'models/seg-5epoch.pt'  # Replace with your actual model path
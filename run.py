@@ -1,10 +1,11 @@
 import os
+import queue
+import threading
 import mlflow
 from annotations import annotation
 import numpy as np
 import PIL
 from norfair import Tracker, Video
-from norfair.camera_motion import MotionEstimator
 from norfair.distances import mean_euclidean
 from config import Config
 from homography.compute_homography import FieldHomographyEstimator
@@ -12,115 +13,78 @@ from homography.homography_utils import log_fail_counts_to_mlflow
 from inference import Converter, InertiaClassifier, NNClassifier
 from inference.detector import SahiBallDetection, Yolov8Detection
 from run_utils import (
+    FrameSelector,
+    FrameWriter,
     get_main_ball,
     get_main_ref,
-    update_motion_estimator
+    PostProcessor,
+    read_frames,
 )
 from game import Match, Player, Team, MatchStats
 from annotations.paths import AbsolutePath
 
-config = Config.from_args()
-video = Video(input_path=config.video_path)
 
-# Object Detectors
-ball_detector = SahiBallDetection()
-std_detector = Yolov8Detection()
+def get_detections(frame: np.ndarray) -> tuple:
+    """Run the detectors on a frame, returns player, referee, ball and keypoint detections"""
+    predictions, keypoint_predictions = std_detector.predict(frame)
+    player_detections, ref_detections, ball_detections = std_detector.get_all_detections(predictions)
+    if not ball_detections:
+        ball_predictions = ball_detector.predict(frame)
+        ball_detections = ball_detector.get_ball_detections(ball_predictions)
+    keypoint_detections = std_detector.get_keypoint_detections(keypoint_predictions)
+    return player_detections, ref_detections, ball_detections, keypoint_detections
 
-# Color Classifier
-nn_classifier = NNClassifier('models/model_path2.pt', ['dublin', 'kerry', 'referee'])
-classifier = InertiaClassifier(classifier=nn_classifier, inertia=20)
 
-# Instantiate Match
-home = Team(
-    name=config.home['name'],
-    color=config.home['color'],
-    abbreviation=config.home['abbreviation'],
-    text_color=config.home['text_color']
-)
-away = Team(
-    name=config.away['name'],
-    color=config.away['color'],
-    abbreviation=config.away['abbreviation'],
-    text_color=config.away['text_color']
-)
-teams = [home, away]
-match = Match(home, away, fps=config.fps)
-match.team_possession = home
-
-# Tracking
-player_tracker = Tracker(
-    distance_function=mean_euclidean,
-    distance_threshold=250,
-    initialization_delay=3,
-    hit_counter_max=90,
-)
-referee_tracker = Tracker(
-    distance_function=mean_euclidean,
-    distance_threshold=250,
-    initialization_delay=3,
-    hit_counter_max=90,
-)
-ball_tracker = Tracker(
-    distance_function=mean_euclidean,
-    distance_threshold=250,
-    initialization_delay=3,
-    hit_counter_max=2000,
-)
-keypoint_tracker = Tracker(
-    distance_function=mean_euclidean,
-    distance_threshold=50,
-    initialization_delay=1,
-    hit_counter_max=1000,
-)
-motion_estimator = MotionEstimator()
-coord_transformations = None
-
-# Instantiate Ball Path
-path = AbsolutePath()
-
-possession_background = annotation.get_possession_background()
-#passes_background = annotation.get_passes_background()
-
-# MLFlow
-EXPERIMENT_NAME = "GAA CV Model"
-client = mlflow.tracking.MlflowClient()
-experiment_id = client.get_experiment_by_name(EXPERIMENT_NAME)
-if experiment_id is None:
-    EXPERIMENT_ID = mlflow.create_experiment(EXPERIMENT_NAME)
-else:
-    EXPERIMENT_ID = experiment_id.experiment_id
-RUN_NAME = f"run_2"
-save_path = f'datasets/{RUN_NAME}/'
-os.makedirs(save_path, exist_ok=True)
-total_balls_detected = 0
-with mlflow.start_run(experiment_id=EXPERIMENT_ID, run_name=RUN_NAME) as run:
-
-    for i, frame in enumerate(video):
-        # Get Detections
-        predictions, keypoint_predictions = std_detector.predict(frame)
-        player_detections, ref_detections, ball_detections = std_detector.get_all_detections(predictions)
-        if not ball_detections:
-            ball_predictions = ball_detector.predict(frame)
-            ball_detections = ball_detector.get_ball_detections(ball_predictions)
-        keypoint_detections = std_detector.get_keypoint_detections(keypoint_predictions)
-        detections = ball_detections + player_detections + ref_detections
+def detect_frames(frames: FrameSelector, detections_queue: queue.Queue):
+    """Detection branch, runs the detectors on the selected frames and skips the rest
+
+    Errors are put on the queue for the main thread to re-raise, the None sentinel
+    is always put last so the consumer never waits on a dead thread.
+    """
+    try:
+        for i, (frame, run_detector) in enumerate(frames):
+            detections = get_detections(frame) if run_detector else None
+            detections_queue.put((i, frame, detections))
+    except BaseException as error:
+        detections_queue.put(error)
+    finally:
+        detections_queue.put(None)
+
+
+def process_frame(
+    i: int, frame: np.ndarray, detections: tuple, period: int, coord_transformations
+):
+    """Track, classify, update the match and annotate a frame
+
+    detections is None on frames where the detector was skipped, there the trackers
+    estimates are used as detections and the last classification is kept.
+    """
+    global total_balls_detected
+
+    if detections is None:
+        # Propagate tracks
+        player_track_objects = player_tracker.update(coord_transformations=coord_transformations)
+        ball_track_objects = ball_tracker.update(coord_transformations=coord_transformations)
+        ref_track_objects = referee_tracker.update(coord_transformations=coord_transformations)
+        keypoint_track_objects = keypoint_tracker.update(coord_transformations=coord_transformations)
+        player_detections = Converter.TrackedObjects_to_Predicted_Detections(player_track_objects)
+        ball_detections = Converter.TrackedObjects_to_Predicted_Detections(ball_track_objects)
+        ref_detections = Converter.TrackedObjects_to_Predicted_Detections(ref_track_objects)
+        keypoint_detections = Converter.TrackedObjects_to_Predicted_Detections(keypoint_track_objects)
+    else:
+        player_detections, ref_detections, ball_detections, keypoint_detections = detections
         # Update trackers
-        coord_transformations = update_motion_estimator(
-            motion_estimator=motion_estimator,
-            detections=detections,
-            frame=frame,
-        )
         player_track_objects = player_tracker.update(
-            detections=player_detections, coord_transformations=coord_transformations
+            detections=player_detections, period=period, coord_transformations=coord_transformations
         )
         ball_track_objects = ball_tracker.update(
-            detections=ball_detections, coord_transformations=coord_transformations
+            detections=ball_detections, period=period, coord_transformations=coord_transformations
         )
         ref_track_objects = referee_tracker.update(
-            detections=ref_detections, coord_transformations=coord_transformations
+            detections=ref_detections, period=period, coord_transformations=coord_transformations
         )
         keypoint_track_objects = keypoint_tracker.update(
-            detections=keypoint_detections, coord_transformations=coord_transformations
+            detections=keypoint_detections, period=period, coord_transformations=coord_transformations
         )
         # Integrate Detections & Tracks
         player_detections = Converter.TrackedObjects_to_Detections(player_track_objects)
@@ -131,76 +95,192 @@ with mlflow.start_run(experiment_id=EXPERIMENT_ID, run_name=RUN_NAME) as run:
             detections=player_detections,
             img=frame,
         )
-        # Compute Homography
-        field_homography_estimator = FieldHomographyEstimator()
-        field_homography_estimator.update_with_detections(keypoint_detections)
-        # Match update
-        ball = get_main_ball(ball_detections)
-        referee = get_main_ref(ref_detections)
-        players = Player.from_detections(detections=player_detections, teams=teams)
-        # Apply Homography to Localize Players
-        players = field_homography_estimator.apply_to_player(players)
+    # Compute Homography
+    field_homography_estimator = FieldHomographyEstimator()
+    field_homography_estimator.update_with_detections(keypoint_detections)
+    # Match update
+    ball = get_main_ball(ball_detections)
+    referee = get_main_ref(ref_detections)
+    players = Player.from_detections(detections=player_detections, teams=teams)
+    # Apply Homography to Localize Players
+    players = field_homography_estimator.apply_to_player(players)
+    if players:
+        match.update(players, ball)
+
+    # Annotations & counters
+    frame = Player.draw_players(
+        players=players, frame=frame, confidence=False, id=True
+    )
+    frame = PIL.Image.fromarray(frame)
+    frame = path.draw(
+        img=frame,
+        detection=ball.detection,
+        coord_transformations=coord_transformations,
+        color=match.possession.team_possession.color,
+    )
+    frame = annotation.draw_possession_counter(
+        config.fps, match, frame, counter_background=possession_background, debug=False
+    )
+    if ball:
+        frame = ball.draw(frame)
+        total_balls_detected += 1
+    if referee:
+        frame = referee.draw(frame)
+    #frame = annotation.draw_passes_counter(
+    #    match, frame, counter_background=passes_background, debug=False
+    #)
+
+    if i % 100 == 0:
+        print(f"Metrics for frame {i}")
+        frame.save(f'frame_{i}.png')  # Save to file
+
+        metrics_dict = {}
+
         if players:
-            match.update(players, ball)
+            for player in players:
+                # Create unique keys for each metric
+                x_key = f"Player_{player.detection.data['id']}_{player.team}_X"
+                y_key = f"Player_{player.detection.data['id']}_{player.team}_Y"
 
-        frame = PIL.Image.fromarray(frame)
+                # Store the metrics in the dictionary
+                metrics_dict[x_key] = player.txy[0]
+                metrics_dict[y_key] = player.txy[1]
+                # Log player ID and team as params
+                param_key = f"Player_{player.detection.data['id']}_{i}"
+                mlflow.log_param(f"{param_key}_ID", player.detection.data['id'], )
+                mlflow.log_param(f"{param_key}_Team", player.team)
 
-        # Annotations & counters
-        frame = Player.draw_players(
-            players=players, frame=frame, confidence=False, id=True
-        )
-        frame = path.draw(
-            img=frame,
-            detection=ball.detection,
-            coord_transformations=coord_transformations,
-            color=match.possession.team_possession.color,
-        )
-        frame = annotation.draw_possession_counter(
-            config.fps, match, frame, counter_background=possession_background, debug=False
+            # Add frame index to the metrics dictionary
+            metrics_dict['Frame'] = i
+            frame.save(f'{save_path}frame_{i}.png')
+            # Add time in seconds
+            metrics_dict['Timestamp'] = i / config.fps
+            # Log metrics
+            mlflow.log_metrics(metrics_dict)
+    # Write video
+    frame = np.array(frame)
+    frame_writer.write(frame)
+
+
+if __name__ == "__main__":
+    config = Config.from_args()
+    video = Video(input_path=config.video_path)
+
+    # Object Detectors
+    ball_detector = SahiBallDetection()
+    std_detector = Yolov8Detection()
+
+    # Color Classifier
+    nn_classifier = NNClassifier('models/model_path2.pt', ['dublin', 'kerry', 'referee'])
+    classifier = InertiaClassifier(classifier=nn_classifier, inertia=20)
+
+    # Instantiate Match
+    home = Team(
+        name=config.home['name'],
+        color=config.home['color'],
+        abbreviation=config.home['abbreviation'],
+        text_color=config.home['text_color']
+    )
+    away = Team(
+        name=config.away['name'],
+        color=config.away['color'],
+        abbreviation=config.away['abbreviation'],
+        text_color=config.away['text_color']
+    )
+    teams = [home, away]
+    match = Match(home, away, fps=config.fps)
+    match.team_possession = home
+
+    # Tracking
+    player_tracker = Tracker(
+        distance_function=mean_euclidean,
+        distance_threshold=250,
+        initialization_delay=3,
+        hit_counter_max=90,
+    )
+    referee_tracker = Tracker(
+        distance_function=mean_euclidean,
+        distance_threshold=250,
+        initialization_delay=3,
+        hit_counter_max=90,
+    )
+    ball_tracker = Tracker(
+        distance_function=mean_euclidean,
+        distance_threshold=250,
+        initialization_delay=3,
+        hit_counter_max=2000,
+    )
+    keypoint_tracker = Tracker(
+        distance_function=mean_euclidean,
+        distance_threshold=50,
+        initialization_delay=1,
+        hit_counter_max=1000,
+    )
+    post_processor = PostProcessor()
+    frame_writer = FrameWriter(video)
+
+    # Instantiate Ball Path
+    path = AbsolutePath()
+
+    possession_background = annotation.get_possession_background()
+    #passes_background = annotation.get_passes_background()
+
+    # MLFlow
+    EXPERIMENT_NAME = "GAA CV Model"
+    client = mlflow.tracking.MlflowClient()
+    experiment_id = client.get_experiment_by_name(EXPERIMENT_NAME)
+    if experiment_id is None:
+        EXPERIMENT_ID = mlflow.create_experiment(EXPERIMENT_NAME)
+    else:
+        EXPERIMENT_ID = experiment_id.experiment_id
+    RUN_NAME = f"run_2"
+    save_path = f'datasets/{RUN_NAME}/'
+    os.makedirs(save_path, exist_ok=True)
+    total_balls_detected = 0
+    with mlflow.start_run(experiment_id=EXPERIMENT_ID, run_name=RUN_NAME) as run:
+
+        # Detectors run on a separate thread and only every few frames,
+        # the trackers propagate the boxes on the frames in between
+        detections_queue = queue.Queue(maxsize=1)
+        detection_thread = threading.Thread(
+            target=detect_frames,
+            args=(FrameSelector(read_frames(video.input_path), detect_every=3), detections_queue),
+            daemon=True,
         )
-        if ball:
-            frame = ball.draw(frame)
-            total_balls_detected += 1
-        if referee:
-            frame = referee.draw(frame)
-        #frame = annotation.draw_passes_counter(
-        #    match, frame, counter_background=passes_background, debug=False
-        #)
-
-        if i % 100 == 0:
-            print(f"Metrics for frame {i}")
-            frame.save(f'frame_{i}.png')  # Save to file
-
-            metrics_dict = {}
-
-            if players:
-                for player in players:
-                    # Create unique keys for each metric
-                    x_key = f"Player_{player.detection.data['id']}_{player.team}_X"
-                    y_key = f"Player_{player.detection.data['id']}_{player.team}_Y"
-
-                    # Store the metrics in the dictionary
-                    metrics_dict[x_key] = player.txy[0]
-                    metrics_dict[y_key] = player.txy[1]
-                    # Log player ID and team as params
-                    param_key = f"Player_{player.detection.data['id']}_{i}"
-                    mlflow.log_param(f"{param_key}_ID", player.detection.data['id'], )
-                    mlflow.log_param(f"{param_key}_Team", player.team)
-
-                # Add frame index to the metrics dictionary
-                metrics_dict['Frame'] = i
-                frame.save(f'{save_path}frame_{i}.png')
-                # Add time in seconds
-                metrics_dict['Timestamp'] = i / config.fps
-                # Log metrics
-                mlflow.log_metrics(metrics_dict)
-        # Write video
-        frame = np.array(frame)
-        video.write(frame)
-
-
-    # Generate summary stats
-    match_stats = MatchStats(match)
-    match_stats()
-    mlflow.log_metric("Total balls detected", total_balls_detected)
-    log_fail_counts_to_mlflow()
+        detection_thread.start()
+
+        try:
+            # Motion estimation of frame i runs on the post processor while frame i - 1 is processed
+            pending = None
+            mask_detections = []
+            frames_since_detection = 0
+            for item in iter(detections_queue.get, None):
+                if isinstance(item, BaseException):
+                    raise item
+                i, frame, detections = item
+                frames_since_detection += 1
+                period = frames_since_detection
+                if detections is not None:
+                    player_detections, ref_detections, ball_detections, _ = detections
+                    mask_detections = ball_detections + player_detections + ref_detections
+                    frames_since_detection = 0
+                post_processor.submit(i, frame, mask_detections)
+                if pending is not None:
+                    _, coord_transformations = post_processor.result()
+                    process_frame(*pending, coord_transformations=coord_transformations)
+                pending = (i, frame, detections, period)
+            detection_thread.join()
+
+            if pending is not None:
+                _, coord_transformations = post_processor.result()
+                process_frame(*pending, coord_transformations=coord_transformations)
+        finally:
+            # releases the shared frame slots and flushes the output on errors too
+            post_processor.close()
+            frame_writer.close()
+
+        # Generate summary stats
+        match_stats = MatchStats(match)
+        match_stats()
+        mlflow.log_metric("Total balls detected", total_balls_detected)
+        log_fail_counts_to_mlflow()
@@ -71,9 +71,8 @@ ball = get_main_ball(ball_detections)
 referee = get_main_ref(ref_detections)
 players = Player.from_detections(detections=player_detections, teams=teams)
 match.update(players, ball)
-single_frame = Image.fromarray(single_frame)
-
 single_frame = Player.draw_players(players=players, frame=single_frame, confidence=False, id=True)
+single_frame = Image.fromarray(single_frame)
 single_frame = path.draw(img=single_frame, detection=ball.detection, coord_transformations=coord_transformations, color=match.team_possession.color)
 single_frame = annotation.draw_possession_counter(config.fps, match, single_frame, counter_background=possession_background, debug=False)
 if ball:
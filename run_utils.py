@@ -1,46 +1,71 @@
-from typing import List, Tuple
+import multiprocessing as mp
+import queue
+from multiprocessing import shared_memory
+from typing import Iterable, Iterator, List, Tuple
+import cv2
 import norfair
 import numpy as np
 from matplotlib import pyplot as plt
 from norfair import Detection
 from norfair.camera_motion import MotionEstimator
-from inference import Converter
 from game import Referee, Ball, Match
 from inference.detector import BaseDetection
 
 
-def create_mask(frame: np.ndarray, detections: List[norfair.Detection]) -> np.ndarray:
-    """
-
-    Creates mask in order to hide detections and goal counter for motion estimation
-
-    Parameters
-    ----------
-    frame : np.ndarray
-        Frame to create mask for.
-    detections : List[norfair.Detection]
-        Detections to hide.
-
-    Returns
-    -------
-    np.ndarray
-        Mask.
-    """
-
-    if not detections:
-        mask = np.ones(frame.shape[:2], dtype=frame.dtype)
-    else:
-        detections_df = Converter.Detections_to_DataFrame(detections)
-        mask = BaseDetection.generate_predictions_mask(predictions=detections_df, img=frame, margin=40)
-
-    # remove goal counter
-    mask[363:118, 856:64] = 0
-    # remove broadcaster logo
-    mask[1589:143, 1805:95] = 0
-    return mask
-
-
-def apply_mask(img: np.ndarray, mask: np.ndarray) -> np.ndarray:
+class MaskBuilder:
+    def __init__(self, margin: int = 40):
+        """
+
+        Builds the motion estimation masks into one buffer reused across frames
+
+        The returned mask is overwritten by the next call, copy it if it has to
+        outlive the current frame.
+
+        Parameters
+        ----------
+        margin : int, optional
+            Margin to add around each detection, by default 40
+        """
+        self.margin = margin
+        self._mask = None
+
+    def create_mask(self, frame: np.ndarray, detections: List[norfair.Detection]) -> np.ndarray:
+        """
+
+        Creates mask in order to hide detections and goal counter for motion estimation
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            Frame to create mask for.
+        detections : List[norfair.Detection]
+            Detections to hide.
+
+        Returns
+        -------
+        np.ndarray
+            Mask.
+        """
+        if (
+            self._mask is None
+            or self._mask.shape != frame.shape[:2]
+            or self._mask.dtype != frame.dtype
+        ):
+            self._mask = np.empty(frame.shape[:2], dtype=frame.dtype)
+
+        boxes = np.array([detection.points for detection in detections]).reshape(-1, 4)
+        mask = BaseDetection.generate_predictions_mask_fast(
+            boxes_xyxy=boxes, shape=frame.shape, margin=self.margin, out=self._mask
+        )
+
+        # remove goal counter, corners (363, 118) and (856, 64)
+        mask[64:118, 363:856] = 0
+        # remove broadcaster logo, corners (1589, 143) and (1805, 95)
+        mask[95:143, 1589:1805] = 0
+        return mask
+
+
+def apply_mask(img: np.ndarray, mask: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """
     Applies a mask to an img
 
@@ -49,22 +74,29 @@ def apply_mask(img: np.ndarray, mask: np.ndarray) -> np.ndarray:
     img : np.ndarray
         Image to apply the mask to
     mask : np.ndarray
-        Mask to apply
+        Mask of 0s and 1s to apply, as created by MaskBuilder.create_mask
+    out : np.ndarray, optional
+        Buffer to write the masked img to, by default img is masked in place.
+        Pass a preallocated buffer to keep img untouched.
 
     Returns
     -------
     np.ndarray
         img with mask applied
     """
-    masked_img = img.copy()
-    masked_img[mask == 0] = 0
-    return masked_img
+    if out is None:
+        out = img
+    if img.ndim == 3:
+        mask = mask[:, :, None]
+    np.multiply(img, mask, out=out)
+    return out
 
 
 def update_motion_estimator(
     motion_estimator: MotionEstimator,
     detections: List[Detection],
     frame: np.ndarray,
+    mask_builder: MaskBuilder = None,
 ) -> "CoordinatesTransformation":
     """
 
@@ -78,18 +110,320 @@ def update_motion_estimator(
         List of detections to hide in the mask
     frame : np.ndarray
         Current frame
+    mask_builder : MaskBuilder, optional
+        Mask builder holding the mask buffer reused across frames, by default a new one
 
     Returns
     -------
     CoordinatesTransformation
         Coordinate transformation for the current frame
     """
+    if mask_builder is None:
+        mask_builder = MaskBuilder()
 
-    mask = create_mask(frame=frame, detections=detections)
+    mask = mask_builder.create_mask(frame=frame, detections=detections)
     coord_transformations = motion_estimator.update(frame, mask=mask) # should have mask=mask in args
     return coord_transformations
 
 
+def _post_process_worker(
+    shm_name: str,
+    frames_shape: tuple,
+    dtype: str,
+    input_queue: mp.Queue,
+    output_queue: mp.Queue,
+):
+    """
+    PostProcessor process loop, runs the motion estimator on frames read from shared memory
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(frames_shape, dtype=dtype, buffer=shm.buf)
+    motion_estimator = MotionEstimator()
+    mask_builder = MaskBuilder()
+
+    while True:
+        item = input_queue.get()
+        if item is None:
+            break
+        frame_id, slot, detections = item
+        coord_transformations = update_motion_estimator(
+            motion_estimator=motion_estimator,
+            detections=detections,
+            frame=frames[slot],
+            mask_builder=mask_builder,
+        )
+        output_queue.put((frame_id, coord_transformations))
+
+    del frames
+    shm.close()
+
+
+class PostProcessor:
+    def __init__(self, slots: int = 2, timeout: float = 1.0):
+        """
+
+        Runs camera motion estimation on a daemon process, so it overlaps with
+        the detectors forward pass of the next frame in the main process.
+
+        Frames are passed through a ring of shared memory slots, only the
+        detection boxes go through the input queue. Results come back in
+        submission order.
+
+        The worker is spawned rather than forked, by the time it starts the
+        main process has loaded torch and runs the detector thread, and a
+        forked child of a threaded cv2/OpenMP process can deadlock.
+
+        Parameters
+        ----------
+        slots : int, optional
+            Number of frames that can be in flight, by default 2
+        timeout : float, optional
+            Seconds between worker liveness checks while waiting for a result, by default 1.0
+        """
+        self.slots = slots
+        self.timeout = timeout
+        self.shm = None
+        self.frames = None
+        self.process = None
+        self.context = mp.get_context("spawn")
+        self.input_queue = self.context.Queue(maxsize=slots)
+        self.output_queue = self.context.Queue(maxsize=slots)
+
+    def start(self, frame: np.ndarray):
+        """
+        Allocate the shared frame slots and start the worker process
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            Frame with the shape and dtype of every submitted frame
+        """
+        frames_shape = (self.slots,) + frame.shape
+        self.shm = shared_memory.SharedMemory(create=True, size=frame.nbytes * self.slots)
+        self.frames = np.ndarray(frames_shape, dtype=frame.dtype, buffer=self.shm.buf)
+        self.process = self.context.Process(
+            target=_post_process_worker,
+            args=(self.shm.name, frames_shape, frame.dtype.str, self.input_queue, self.output_queue),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, frame_id: int, frame: np.ndarray, detections: List[Detection]):
+        """
+
+        Queue a frame for motion estimation
+
+        At most `slots` frames can be waiting for their result, call result()
+        before submitting more.
+
+        Parameters
+        ----------
+        frame_id : int
+            Frame index
+        frame : np.ndarray
+            Current frame
+        detections : List[Detection]
+            List of detections to hide in the mask
+        """
+        if self.process is None:
+            self.start(frame)
+
+        slot = frame_id % self.slots
+        self.frames[slot] = frame
+        # only the boxes are needed for the mask, keep masks and tensors out of the queue
+        boxes = [Detection(points=detection.points) for detection in detections]
+        self.input_queue.put((frame_id, slot, boxes))
+
+    def result(self) -> Tuple[int, "CoordinatesTransformation"]:
+        """
+        Wait for the oldest submitted frame
+
+        Returns
+        -------
+        Tuple[int, CoordinatesTransformation]
+            Frame index and coordinate transformation for that frame
+
+        Raises
+        ------
+        RuntimeError
+            If the worker process died before returning the result
+        """
+        while True:
+            try:
+                return self.output_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                if self.process is None or not self.process.is_alive():
+                    raise RuntimeError("PostProcessor worker process is not running")
+
+    def close(self):
+        """
+        Stop the worker process and release the shared frame slots
+        """
+        if self.process is not None:
+            try:
+                if self.process.is_alive():
+                    self.input_queue.put(None, timeout=self.timeout)
+                    self.process.join(timeout=self.timeout)
+            except queue.Full:
+                pass
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+        if self.shm is not None:
+            self.frames = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+
+class FrameWriter:
+    def __init__(self, video: norfair.Video):
+        """
+
+        Writes the annotated frames to the output file of a norfair Video.
+
+        Video releases its own writer as soon as its generator reads the last
+        frame, before the frames still held by the pipeline are written, so the
+        writer is owned here and released by close after the last write.
+
+        Parameters
+        ----------
+        video : norfair.Video
+            Video giving the output path, codec and fps
+        """
+        self.video = video
+        self.writer = None
+
+    def write(self, frame: np.ndarray):
+        """
+        Write a frame, the writer is opened with the size of the first frame
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            Annotated frame
+        """
+        if self.writer is None:
+            output_path = self.video.get_output_file_path()
+            fourcc = cv2.VideoWriter_fourcc(*self.video.get_codec_fourcc(output_path))
+            self.writer = cv2.VideoWriter(
+                output_path, fourcc, self.video.output_fps, (frame.shape[1], frame.shape[0])
+            )
+        self.writer.write(frame)
+
+    def close(self):
+        """
+        Release the writer, flushing the output file
+        """
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+            print(f"Output video file saved to: {self.video.get_output_file_path()}")
+
+
+def read_frames(path: str) -> Iterator[np.ndarray]:
+    """
+    Read the frames of a video file through a dedicated cv2.VideoCapture
+
+    Unlike iterating a norfair Video, reaching the end doesn't release the
+    output writer, so it is safe to consume from the detection thread.
+
+    Parameters
+    ----------
+    path : str
+        Path to the video file
+
+    Returns
+    -------
+    Iterator[np.ndarray]
+        Frames of the video
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        while True:
+            ret, frame = capture.read()
+            if not ret or frame is None:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+class FrameSelector:
+    def __init__(
+        self,
+        frames: Iterable[np.ndarray],
+        detect_every: int = 3,
+        scene_change_threshold: float = None,
+        scale: float = 0.125,
+    ):
+        """
+
+        Decides on which frames the detectors run, the trackers propagate the
+        boxes on the frames in between.
+
+        Parameters
+        ----------
+        frames : Iterable[np.ndarray]
+            Video frames
+        detect_every : int, optional
+            Run the detectors every n frames, by default 3
+        scene_change_threshold : float, optional
+            Also run the detectors when the mean absolute difference between the
+            downsampled greyscale frame and the last detected one is greater than
+            this value, by default None (disabled)
+        scale : float, optional
+            Downsampling factor used for the scene change check, by default 0.125
+        """
+        self.frames = frames
+        self.detect_every = detect_every
+        self.scene_change_threshold = scene_change_threshold
+        self.scale = scale
+
+    def small_grey(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Downsampled greyscale copy of the frame used for the scene change check
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            Current frame
+
+        Returns
+        -------
+        np.ndarray
+            Downsampled greyscale frame
+        """
+        grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(grey, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, bool]]:
+        frames_since_detection = None
+        last_detected = None
+
+        for frame in self.frames:
+            run_detector = (
+                frames_since_detection is None
+                or frames_since_detection + 1 >= self.detect_every
+            )
+
+            small = None
+            if self.scene_change_threshold is not None:
+                small = self.small_grey(frame)
+                if not run_detector and last_detected is not None:
+                    scene_change = cv2.absdiff(small, last_detected).mean()
+                    run_detector = scene_change > self.scene_change_threshold
+
+            if run_detector:
+                frames_since_detection = 0
+                last_detected = small
+            else:
+                frames_since_detection += 1
+
+            yield frame, run_detector
+
 
 def get_main_ref(detections: List[Detection]) -> Referee:
     """
@@ -140,30 +474,78 @@ def get_main_ball(detections: List[Detection], match: Match = None) -> Ball:
 
     return ball
 
-def plot_points(dst_points, players):
-    """Plot the dst points and players' txy points."""
-
-    # Extract player txy points
-    txy_points = [player.txy for player in players]
-
-    # Unzip the points for plotting
-    if txy_points:
-        dst_x, dst_y = zip(*dst_points)
-        txy_x, txy_y = zip(*txy_points)
+class PointsPlotter:
+    def __init__(self):
+        """
+
+        Live scatter of the dst points and players txy points
+
+        The figure, axes and artists are created once on the first update,
+        later updates only move the points and blit the axes.
+        """
+        self.fig = None
+        self.ax = None
+        self.dst_scatter = None
+        self.txy_scatter = None
+        self.background = None
+
+    def setup(self):
+        """
+        Create the figure and cache its static background for blitting
+        """
+        self.fig, self.ax = plt.subplots(figsize=(15, 9))
+
+        self.dst_scatter = self.ax.scatter([], [], color='red', label='Dst Points', animated=True)
+        self.txy_scatter = self.ax.scatter([], [], color='blue', label='Player txy Points', animated=True)
+
+        self.ax.set_xlim(0, 145)  # Setting x-axis limits based on the field dimensions
+        self.ax.set_ylim(0, 88)  # Setting y-axis limits based on the field dimensions
+
+        self.ax.set_xlabel('X')
+        self.ax.set_ylabel('Y')
+        self.ax.set_title('Dst Points and Player txy Points')
+        self.ax.invert_yaxis()  # This makes the plot's orientation similar to a football field's
+        self.ax.legend()
+        self.ax.grid(True)
+
+        plt.show(block=False)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+
+    def update(self, dst_points, players):
+        """
+        Redraw the points
+
+        Parameters
+        ----------
+        dst_points : array_like
+            Dst points (x, y)
+        players : List[Player]
+            Players with txy computed
+        """
+        txy_points = [player.txy for player in players if player.txy is not None]
+        if not txy_points:
+            return
+
+        if self.fig is None:
+            self.setup()
+
+        self.fig.canvas.restore_region(self.background)
+        self.dst_scatter.set_offsets(np.asarray(dst_points))
+        self.txy_scatter.set_offsets(np.asarray(txy_points))
+        self.ax.draw_artist(self.dst_scatter)
+        self.ax.draw_artist(self.txy_scatter)
+        self.fig.canvas.blit(self.ax.bbox)
+        self.fig.canvas.flush_events()
+
+
+DEBUG_PLOT = False
+points_plotter = PointsPlotter()
 
-        # Plot the points
-        plt.figure(figsize=(15, 9))
 
-        plt.scatter(dst_x, dst_y, color='red', label='Dst Points')
-        plt.scatter(txy_x, txy_y, color='blue', label='Player txy Points')
-
-        plt.xlim(0, 145)  # Setting x-axis limits based on the field dimensions
-        plt.ylim(0, 88)  # Setting y-axis limits based on the field dimensions
+def plot_points(dst_points, players):
+    """Plot the dst points and players' txy points, only when DEBUG_PLOT is enabled."""
+    if not DEBUG_PLOT:
+        return
 
-        plt.xlabel('X')
-        plt.ylabel('Y')
-        plt.title('Dst Points and Player txy Points')
-        plt.gca().invert_yaxis()  # This makes the plot's orientation similar to a football field's
-        plt.legend()
-        plt.grid(True)
-        plt.show()
+    points_plotter.update(dst_points, players)